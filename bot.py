@@ -4,10 +4,16 @@ import asyncio
 import subprocess
 import signal
 import psutil
-import json
+import orjson
 import threading
 import shutil
 import time
+import itertools
+import functools
+import hashlib
+import atexit
+import hmac
+import secrets
 from urllib.parse import quote_plus
 
 from flask import Flask, request
@@ -32,6 +38,8 @@ logger = logging.getLogger("python-host-bot")
 TOKEN = os.environ.get("TOKEN", "").strip()
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
 BASE_URL = os.environ.get("RENDER_EXTERNAL_URL", "http://localhost:8080")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token on every webhook call
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
 
 UPLOAD_DIR = "scripts"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -39,7 +47,20 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 USERS_FILE = "allowed_users.json"
 OWNERSHIP_FILE = "ownership.json"
 
-running_processes = {}  # {target_id: {"process": Popen, "log": log_path}}
+# per-target process state, one flat map per field
+_procs = {}        # {target_id: Popen}
+_procs_alive = {}  # {target_id: bool}, flipped to False by the pidfd exit watcher
+
+def is_running(target_id):
+    alive = _procs_alive.get(target_id)
+    if alive is not None:
+        return alive
+    # not watched (no pidfd support): ask the process
+    proc = _procs.get(target_id)
+    return proc is not None and proc.poll() is None
+
+# decoded once; hosted scripts get a copy plus their own .env on top
+_BASE_ENV = dict(os.environ)
 
 # =========================
 # FLASK SERVER (Render requires PORT open)
@@ -63,7 +84,7 @@ def script_status():
     if not script_name:
         return "Specify script", 400
 
-    if script_name in running_processes and running_processes[script_name]["process"].poll() is None:
+    if is_running(script_name):
         return f"✅ {script_name} is running.", 200
     return f"❌ {script_name} is stopped.", 404
 
@@ -73,6 +94,39 @@ def run_flask_forever():
     # Flask dev server is OK for Render simple health endpoints
     app.run(host="0.0.0.0", port=port)
 
+# =========================
+# TELEGRAM WEBHOOK (served by the Flask app above)
+# =========================
+_tg_app = None   # telegram Application, set by enable_webhook()
+_tg_loop = None  # event loop the Application runs on
+
+@app.route("/tg/<token>", methods=["POST"])
+def telegram_webhook(token):
+    if not TOKEN or _tg_app is None or not hmac.compare_digest(token.encode(), TOKEN.encode()):
+        return "", 404
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return "", 403
+    update = Update.de_json(request.get_json(force=True), _tg_app.bot)
+    # go through the update queue so PTB's concurrent_updates setting applies
+    fut = asyncio.run_coroutine_threadsafe(_tg_app.update_queue.put(update), _tg_loop)
+    fut.add_done_callback(_log_update_error)
+    return "", 200
+
+def _log_update_error(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("Webhook update failed", exc_info=fut.exception())
+
+async def enable_webhook(application):
+    """Receive updates via /tg/<TOKEN> instead of long polling.
+
+    `application` must already be initialized and started (no run_polling).
+    """
+    global _tg_app, _tg_loop
+    _tg_app = application
+    _tg_loop = asyncio.get_running_loop()
+    await application.bot.set_webhook(f"{BASE_URL}/tg/{TOKEN}", secret_token=WEBHOOK_SECRET)
+
 # =========================
 # JSON helpers
 # =========================
@@ -80,51 +134,132 @@ def _safe_load_json(path, default):
     if not os.path.exists(path):
         return default
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except:
         return default
 
-def _safe_save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f)
+def _atomic_write(path, raw: bytes):
+    # temp file + rename: a crash mid-write never leaves a truncated file
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+    os.replace(tmp, path)
+
+def _dumps_state(obj):
+    # sets (allowed users) are persisted as a sorted JSON list
+    return orjson.dumps(sorted(obj) if isinstance(obj, set) else obj)
+
+# In-memory state, loaded once at import. The JSON files are only a
+# write-behind copy so the state survives restarts.
+def _load_users():
+    raw = _safe_load_json(USERS_FILE, [])
+    if not isinstance(raw, list):
+        logger.warning("%s is not a list, starting with no allowed users", USERS_FILE)
+        return set()
+    users = set()
+    for u in raw:
+        try:
+            users.add(int(u))
+        except (TypeError, ValueError):
+            logger.warning("Skipping invalid user id in %s: %r", USERS_FILE, u)
+    return users
+
+_users_set = _load_users()
+_ownership = _safe_load_json(OWNERSHIP_FILE, {})
+
+FLUSH_DELAY = 0.5  # seconds; coalesces bursts of changes into one write
+_dirty = {}  # {path: state object with unsaved changes}
+_flush_task = None
+
+async def _flush_later():
+    while _dirty:
+        await asyncio.sleep(FLUSH_DELAY)
+        pending = dict(_dirty)
+        _dirty.clear()
+        for path, obj in pending.items():
+            # serialize on the loop thread (no concurrent mutation), write off it
+            try:
+                await asyncio.to_thread(_atomic_write, path, _dumps_state(obj))
+            except Exception as e:
+                logger.error("Saving %s failed, will retry: %s", path, e)
+                _dirty.setdefault(path, obj)
+
+def flush_state():
+    """Write any pending state changes synchronously (also run at exit)."""
+    for path in list(_dirty):
+        obj = _dirty.pop(path)
+        try:
+            _atomic_write(path, _dumps_state(obj))
+        except Exception as e:
+            logger.error("Saving %s failed: %s", path, e)
+            _dirty[path] = obj
+
+atexit.register(flush_state)
+
+def _mark_dirty(path, obj):
+    global _flush_task
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _atomic_write(path, _dumps_state(obj))
+        return
+    _dirty[path] = obj
+    if _flush_task is None or _flush_task.done():
+        _flush_task = loop.create_task(_flush_later())
 
 def get_allowed_users():
-    return _safe_load_json(USERS_FILE, [])
+    return _users_set
 
 def save_allowed_user(uid: int):
-    users = get_allowed_users()
-    if uid not in users:
-        users.append(uid)
-        _safe_save_json(USERS_FILE, users)
-        return True
-    return False
+    if uid in _users_set:
+        return False
+    _users_set.add(uid)
+    _mark_dirty(USERS_FILE, _users_set)
+    return True
 
 def remove_allowed_user(uid: int):
-    users = get_allowed_users()
-    if uid in users:
-        users.remove(uid)
-        _safe_save_json(USERS_FILE, users)
-        return True
-    return False
+    if uid not in _users_set:
+        return False
+    _users_set.discard(uid)
+    _mark_dirty(USERS_FILE, _users_set)
+    return True
 
 def load_ownership():
-    return _safe_load_json(OWNERSHIP_FILE, {})
+    return _ownership
+
+def _launch_paths(target_id: str):
+    if "|" in target_id:
+        repo, file_rel = target_id.split("|", 1)
+        work_dir = os.path.join(UPLOAD_DIR, repo)
+        script, env = file_rel, os.path.join(work_dir, ".env")
+    else:
+        work_dir = UPLOAD_DIR
+        script, env = target_id, os.path.join(work_dir, f"{target_id}.env")
+    log = os.path.join(UPLOAD_DIR, f"{target_id.replace('|','_')}.log")
+    return {"work_dir": work_dir, "script": script, "env": env, "log": log}
+
+def get_launch_paths(target_id: str):
+    meta = _ownership.get(target_id)
+    if meta is None:
+        return _launch_paths(target_id)
+    if "script" not in meta:
+        # entry saved before paths were stored: fill in once
+        meta.update(_launch_paths(target_id))
+    return meta
 
 def save_ownership(target_id: str, user_id: int, type_: str):
-    data = load_ownership()
-    data[target_id] = {"owner": user_id, "type": type_}
-    _safe_save_json(OWNERSHIP_FILE, data)
+    _ownership[target_id] = {"owner": user_id, "type": type_, **_launch_paths(target_id)}
+    _mark_dirty(OWNERSHIP_FILE, _ownership)
 
 def delete_ownership(target_id: str):
-    data = load_ownership()
-    if target_id in data:
-        del data[target_id]
-        _safe_save_json(OWNERSHIP_FILE, data)
+    if target_id not in _ownership:
+        return
+    del _ownership[target_id]
+    _mark_dirty(OWNERSHIP_FILE, _ownership)
 
 def get_owner(target_id: str):
-    data = load_ownership()
-    return data.get(target_id, {}).get("owner")
+    return _ownership.get(target_id, {}).get("owner")
 
 # =========================
 # ACCESS CONTROL
@@ -132,7 +267,7 @@ def get_owner(target_id: str):
 def restricted(func):
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         uid = update.effective_user.id
-        if uid != ADMIN_ID and uid not in get_allowed_users():
+        if uid != ADMIN_ID and uid not in _users_set:
             if update.message:
                 await update.message.reply_text("⛔ Access Denied.")
             else:
@@ -152,18 +287,37 @@ def super_admin_only(func):
 # =========================
 # KEYBOARDS
 # =========================
+# built once; markups are immutable so every reply can share them
+MAIN_MENU_KB = ReplyKeyboardMarkup([
+    ["📤 Upload File", "🌐 Clone from Git"],
+    ["🚀 Deploy to Render", "📂 My Hosted Apps"],
+    ["📊 Server Stats", "🆘 Help"]
+], resize_keyboard=True)
+
+EXTRAS_KB = ReplyKeyboardMarkup(
+    [["➕ Add reqs", "➕ Add .env"], ["🚀 RUN NOW", "🔙 Cancel"]],
+    resize_keyboard=True
+)
+
+CANCEL_KB = ReplyKeyboardMarkup([["🔙 Cancel"]], resize_keyboard=True)
+
 def main_menu_keyboard():
-    return ReplyKeyboardMarkup([
-        ["📤 Upload File", "🌐 Clone from Git"],
-        ["🚀 Deploy to Render", "📂 My Hosted Apps"],
-        ["📊 Server Stats", "🆘 Help"]
-    ], resize_keyboard=True)
+    return MAIN_MENU_KB
 
 def extras_keyboard():
-    return ReplyKeyboardMarkup(
-        [["➕ Add reqs", "➕ Add .env"], ["🚀 RUN NOW", "🔙 Cancel"]],
-        resize_keyboard=True
-    )
+    return EXTRAS_KB
+
+# =========================
+# DOWNLOADS
+# =========================
+def _write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+async def _download(file, path):
+    # fetch into memory (bot API caps files at 20 MB), write to disk off the loop
+    buf = await file.download_as_bytearray()
+    await asyncio.to_thread(_write_bytes, path, buf)
 
 # =========================
 # REQUIREMENTS INSTALL
@@ -171,9 +325,9 @@ def extras_keyboard():
 def smart_fix_requirements(req_path):
     try:
         with open(req_path, "r") as f:
-            lines = f.readlines()
+            txt = f.read()
         clean = []
-        for line in lines:
+        for line in txt.splitlines():
             line = line.strip()
             if not line:
                 continue
@@ -187,31 +341,83 @@ def smart_fix_requirements(req_path):
     except:
         return False
 
+# Skip pip when the same requirements file was the last thing installed.
+# All targets share one interpreter, so only the most recent install is
+# remembered: any other install may have changed its pins. This assumes
+# site-packages lives exactly as long as scripts/.req_hashes.json.
+REQ_HASHES_FILE = os.path.join(UPLOAD_DIR, ".req_hashes.json")
+_req_hashes = _safe_load_json(REQ_HASHES_FILE, {})  # {req_path: sha256}, at most one entry
+
 async def install_requirements(req_path, update):
     msg = await update.message.reply_text("⏳ Installing requirements...")
     smart_fix_requirements(req_path)
     try:
+        with open(req_path, "rb") as f:
+            req_hash = hashlib.sha256(f.read()).hexdigest()
+        if _req_hashes.get(req_path) == req_hash:
+            await msg.edit_text("✅ Requirements unchanged, skipping install.")
+            return
+        # even a failed or killed pip may have touched site-packages
+        _req_hashes.clear()
+        _mark_dirty(REQ_HASHES_FILE, _req_hashes)
         proc = await asyncio.create_subprocess_exec(
             "pip", "install", "-r", req_path,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
-        _, stderr = await proc.communicate()
+        try:
+            _, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            # cancelled from cancel / re-clone: don't leave pip running
+            proc.kill()
+            await proc.wait()
+            raise
         if proc.returncode == 0:
+            _req_hashes[req_path] = req_hash
+            _mark_dirty(REQ_HASHES_FILE, _req_hashes)
             await msg.edit_text("✅ Installed!")
         else:
             await msg.edit_text(f"❌ Failed:\n{stderr.decode()[-900:]}")
     except Exception as e:
         await msg.edit_text(f"❌ Error: {e}")
 
+async def await_pending_install(context, work_dir=None):
+    """Wait for a background repo requirements install, if one is pending.
+
+    With `work_dir`, only wait when the pending install belongs to that repo.
+    """
+    if work_dir is not None and context.user_data.get("install_repo") != work_dir:
+        return
+    context.user_data.pop("install_repo", None)
+    task = context.user_data.pop("install_task", None)
+    if task:
+        try:
+            await task
+        except Exception as e:
+            logger.warning("Background requirements install failed: %s", e)
+
+async def cancel_pending_install(context):
+    """Cancel a background install and wait until its pip process is gone."""
+    context.user_data.pop("install_repo", None)
+    task = context.user_data.pop("install_task", None)
+    if task and not task.done():
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+
 # =========================
 # COMMANDS
 # =========================
 @restricted
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _BASE_ENV
+    _BASE_ENV = dict(os.environ)
     await update.message.reply_text("👋 Python & Git Hosting Bot", reply_markup=main_menu_keyboard())
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await cancel_pending_install(context)
     if update.message:
         await update.message.reply_text("🚫 Cancelled.", reply_markup=main_menu_keyboard())
     else:
@@ -225,7 +431,7 @@ WAIT_PY, WAIT_EXTRAS = range(2)
 
 @restricted
 async def upload_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📤 Send a `.py` file.", reply_markup=ReplyKeyboardMarkup([["🔙 Cancel"]], resize_keyboard=True))
+    await update.message.reply_text("📤 Send a `.py` file.", reply_markup=CANCEL_KB)
     return WAIT_PY
 
 async def receive_py(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -243,7 +449,7 @@ async def receive_py(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAIT_PY
 
     path = os.path.join(UPLOAD_DIR, fname)
-    await file.download_to_drive(path)
+    await _download(file, path)
     save_ownership(fname, uid, "file")
 
     context.user_data["type"] = "file"
@@ -285,7 +491,8 @@ async def receive_extra_files(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     if wait == "req" and fname.endswith(".txt"):
         path = os.path.join(work_dir, f"{prefix}_req.txt")
-        await file.download_to_drive(path)
+        await _download(file, path)
+        await await_pending_install(context)  # one pip at a time
         await install_requirements(path, update)
 
     elif wait == "env" and fname.endswith(".env"):
@@ -293,7 +500,7 @@ async def receive_extra_files(update: Update, context: ContextTypes.DEFAULT_TYPE
             path = os.path.join(work_dir, f"{target_id}.env")
         else:
             path = os.path.join(work_dir, ".env")
-        await file.download_to_drive(path)
+        await _download(file, path)
         await update.message.reply_text("✅ Env saved.")
 
     context.user_data["wait"] = None
@@ -305,9 +512,28 @@ async def receive_extra_files(update: Update, context: ContextTypes.DEFAULT_TYPE
 # =========================
 WAIT_URL, WAIT_SELECT_FILE, WAIT_GIT_EXTRAS = range(2, 5)
 
+SKIP_DIRS = {".git", "__pycache__", "venv", ".venv", "node_modules"}
+
+def _iter_py_files(root):
+    # lazy scandir walk: callers only need the first few hits
+    prefix_len = len(os.path.join(root, ""))  # entry paths all start with root + sep
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if e.name not in SKIP_DIRS:
+                            stack.append(e.path)
+                    elif e.name.endswith(".py"):
+                        yield e.path[prefix_len:]
+        except OSError:
+            continue
+
 @restricted
 async def git_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🌐 Send PUBLIC Git repo URL", reply_markup=ReplyKeyboardMarkup([["🔙 Cancel"]], resize_keyboard=True))
+    await update.message.reply_text("🌐 Send PUBLIC Git repo URL", reply_markup=CANCEL_KB)
     return WAIT_URL
 
 async def receive_git_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -320,19 +546,22 @@ async def receive_git_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     repo_path = os.path.join(UPLOAD_DIR, repo_name)
 
     msg = await update.message.reply_text(f"⏳ Cloning `{repo_name}` ...")
+    await cancel_pending_install(context)  # an old pip may still be reading the checkout
     if os.path.exists(repo_path):
-        shutil.rmtree(repo_path)
+        await asyncio.to_thread(shutil.rmtree, repo_path, ignore_errors=True)
 
     try:
-        subprocess.check_call(["git", "clone", url, repo_path])
+        proc = await asyncio.create_subprocess_exec(
+            "git", "clone", "--depth=1", "--single-branch", url, repo_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode()[-900:])
         await msg.edit_text("✅ Cloned Successfully!")
 
-        py_files = []
-        for root, dirs, files in os.walk(repo_path):
-            for f in files:
-                if f.endswith(".py"):
-                    rel_path = os.path.relpath(os.path.join(root, f), repo_path)
-                    py_files.append(rel_path)
+        py_files = list(itertools.islice(_iter_py_files(repo_path), 12))
 
         if not py_files:
             await update.message.reply_text("❌ No .py found.", reply_markup=main_menu_keyboard())
@@ -344,9 +573,11 @@ async def receive_git_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
         req_path = os.path.join(repo_path, "requirements.txt")
         if os.path.exists(req_path):
             await update.message.reply_text("📦 Installing repo requirements.txt ...")
-            await install_requirements(req_path, update)
+            # let pip run while the user picks a file; awaited before launch
+            context.user_data["install_repo"] = repo_path
+            context.user_data["install_task"] = asyncio.create_task(install_requirements(req_path, update))
 
-        keyboard = [[InlineKeyboardButton(f, callback_data=f"sel_py_{f}")] for f in py_files[:12]]
+        keyboard = [[InlineKeyboardButton(f, callback_data=f"sel_py_{f}")] for f in py_files]
         await update.message.reply_text("👇 Select main file:", reply_markup=InlineKeyboardMarkup(keyboard))
         return WAIT_SELECT_FILE
 
@@ -358,7 +589,7 @@ async def select_git_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    filename = query.data.split("sel_py_")[1]
+    filename = query.data.partition("sel_py_")[2]
     repo_path = context.user_data["repo_path"]
     repo_name = context.user_data["repo_name"]
     uid = update.effective_user.id
@@ -390,7 +621,7 @@ WAIT_DEPLOY_REPO = 10
 async def deploy_render_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🚀 Deploy to Render\n\nSend your PUBLIC GitHub repo URL.\nExample:\nhttps://github.com/user/repo",
-        reply_markup=ReplyKeyboardMarkup([["🔙 Cancel"]], resize_keyboard=True),
+        reply_markup=CANCEL_KB,
     )
     return WAIT_DEPLOY_REPO
 
@@ -416,6 +647,64 @@ async def deploy_render_receive(update: Update, context: ContextTypes.DEFAULT_TY
 # =========================
 # RUN SCRIPT
 # =========================
+@functools.lru_cache(maxsize=256)
+def _load_env(path, mtime_ns):
+    # mtime_ns is only part of the cache key: an edited .env gets re-parsed
+    with open(path, "r") as f:
+        txt = f.read()
+    pairs = []
+    for line in txt.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        k, v = line.split("=", 1)
+        pairs.append((k.strip(), v.strip()))
+    return tuple(pairs)
+
+def _tail(path, n=2000):
+    # read only the last n bytes, logs of long-running scripts can be huge
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        data = os.pread(f.fileno(), n, max(0, size - n))
+    return data.decode("utf-8", "replace")
+
+CRASH_WINDOW = 2  # seconds a fresh script must survive to count as running
+
+def _watch_exit(target_id, proc):
+    """Return a future resolved when proc exits, or None without pidfd support."""
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        return None
+
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def _mark_dead():
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        proc.poll()  # reap
+        _procs_alive[target_id] = False
+        if not fut.done():
+            fut.set_result(True)
+
+    try:
+        loop.add_reader(pidfd, _mark_dead)
+    except NotImplementedError:
+        os.close(pidfd)
+        return None
+    _procs_alive[target_id] = True
+    return fut
+
+async def _wait_exit(proc, exited, timeout):
+    """Wait up to `timeout` seconds for proc to exit, return True if it did."""
+    if exited is None:
+        # no pidfd (non-Linux / old kernel): fall back to sleep + poll
+        await asyncio.sleep(timeout)
+        return proc.poll() is not None
+    await asyncio.wait({exited}, timeout=timeout)
+    return exited.done()
+
 async def execute_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg_func = update.message.reply_text if update.message else update.callback_query.message.reply_text
 
@@ -424,51 +713,40 @@ async def execute_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg_func("❌ Missing target ID", reply_markup=main_menu_keyboard())
         return ConversationHandler.END
 
-    if "|" in target_id:
-        repo, file_rel = target_id.split("|", 1)
-        work_dir = os.path.join(UPLOAD_DIR, repo)
-        script_path = file_rel
-        env_path = os.path.join(work_dir, ".env")
-    else:
-        work_dir = UPLOAD_DIR
-        script_path = target_id
-        env_path = os.path.join(work_dir, f"{target_id}.env")
+    paths = get_launch_paths(target_id)
+    work_dir = paths["work_dir"]
+    await await_pending_install(context, work_dir)  # only if it is this repo's install
+    env_path = paths["env"]
+    log_file_path = paths["log"]
 
-    if target_id in running_processes and running_processes[target_id]["process"].poll() is None:
+    if is_running(target_id):
         await msg_func(f"⚠️ `{target_id}` is already running!", reply_markup=main_menu_keyboard(), parse_mode="Markdown")
         return ConversationHandler.END
 
-    custom_env = os.environ.copy()
+    custom_env = _BASE_ENV.copy()
     if os.path.exists(env_path):
-        with open(env_path, "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                k, v = line.split("=", 1)
-                custom_env[k.strip()] = v.strip()
-
-    log_file_path = os.path.join(UPLOAD_DIR, f"{target_id.replace('|','_')}.log")
+        custom_env.update(_load_env(env_path, os.stat(env_path).st_mtime_ns))
+
     log_file = open(log_file_path, "w", buffering=1)
 
     try:
         proc = subprocess.Popen(
-            ["python", "-u", script_path],
+            ["python", "-u", paths["script"]],
             env=custom_env,
             stdout=log_file,
             stderr=subprocess.STDOUT,
             cwd=work_dir,
-            preexec_fn=os.setsid
+            start_new_session=True
         )
-        running_processes[target_id] = {"process": proc, "log": log_file_path}
+        _procs[target_id] = proc
+        _procs_alive.pop(target_id, None)
+        exited = _watch_exit(target_id, proc)
 
         await msg_func(f"🚀 Started!\nID: `{target_id}`\nPID: {proc.pid}", parse_mode="Markdown")
 
-        await asyncio.sleep(2)
-        if proc.poll() is not None:
+        if await _wait_exit(proc, exited, CRASH_WINDOW):
             log_file.close()
-            with open(log_file_path, "r") as f:
-                tail = f.read()[-2000:]
+            tail = _tail(log_file_path)
             await msg_func(f"❌ Crashed:\n```\n{tail}\n```", parse_mode="Markdown", reply_markup=main_menu_keyboard())
         else:
             url = f"{BASE_URL}/status?script={target_id}"
@@ -479,21 +757,33 @@ async def execute_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
+STOP_TIMEOUT = 3  # seconds to wait after SIGTERM before SIGKILL
+
+def _killpg(proc, sig):
+    try:
+        os.killpg(os.getpgid(proc.pid), sig)
+    except:
+        pass
+
+async def _stop_process(proc):
+    _killpg(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.to_thread(proc.wait), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        _killpg(proc, signal.SIGKILL)
+        await asyncio.to_thread(proc.wait)
+
 # =========================
 # LIST / MANAGE
 # =========================
 @restricted
 async def list_hosted(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    ownership = load_ownership()
-    keyboard = []
-
-    for tid, meta in ownership.items():
-        owner = meta.get("owner")
-        if uid == ADMIN_ID or uid == owner:
-            is_running = tid in running_processes and running_processes[tid]["process"].poll() is None
-            status = "🟢" if is_running else "🔴"
-            keyboard.append([InlineKeyboardButton(f"{status} {tid}", callback_data=f"man_{tid}")])
+    keyboard = [
+        [InlineKeyboardButton(f"{'🟢' if is_running(tid) else '🔴'} {tid}", callback_data=f"man_{tid}")]
+        for tid, meta in load_ownership().items()
+        if uid == ADMIN_ID or uid == meta.get("owner")
+    ]
 
     if not keyboard:
         await update.message.reply_text("📂 No hosted apps.", reply_markup=main_menu_keyboard())
@@ -501,62 +791,71 @@ async def list_hosted(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("📂 Your Apps:", reply_markup=InlineKeyboardMarkup(keyboard))
 
+CALLBACK_HANDLERS = {}  # {callback_data prefix: handler(update, context, arg)}
+
+def callback_prefix(prefix):
+    def deco(func):
+        CALLBACK_HANDLERS[prefix] = func
+        return func
+    return deco
+
 async def manage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-    uid = update.effective_user.id
-
-    if data.startswith("sel_py_"):
-        return await select_git_file(update, context)
 
-    if data.startswith("man_"):
-        target_id = data.split("man_")[1]
-        owner = get_owner(target_id)
-        if uid != ADMIN_ID and uid != owner:
-            return await query.message.reply_text("⛔ Not yours.")
+    prefix, _, arg = query.data.partition("_")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler:
+        return await handler(update, context, arg)
 
-        is_running = target_id in running_processes and running_processes[target_id]["process"].poll() is None
-        text = f"⚙️ Manage: `{target_id}`\nStatus: {'🟢 Running' if is_running else '🔴 Stopped'}"
+@callback_prefix("sel")
+async def _cb_select(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    return await select_git_file(update, context)
 
-        btns = []
-        if is_running:
-            btns.append([InlineKeyboardButton("🛑 Stop", callback_data=f"stop_{target_id}")])
-            btns.append([InlineKeyboardButton("🔗 URL", callback_data=f"url_{target_id}")])
-        else:
-            btns.append([InlineKeyboardButton("🚀 Run", callback_data=f"rerun_{target_id}")])
-
-        btns.append([InlineKeyboardButton("📜 Logs", callback_data=f"log_{target_id}")])
-        btns.append([InlineKeyboardButton("🗑️ Delete", callback_data=f"del_{target_id}")])
+@callback_prefix("man")
+async def _cb_manage(update: Update, context: ContextTypes.DEFAULT_TYPE, target_id):
+    query = update.callback_query
+    uid = update.effective_user.id
+    owner = get_owner(target_id)
+    if uid != ADMIN_ID and uid != owner:
+        return await query.message.reply_text("⛔ Not yours.")
 
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode="Markdown")
-        return
+    running = is_running(target_id)
+    text = f"⚙️ Manage: `{target_id}`\nStatus: {'🟢 Running' if running else '🔴 Stopped'}"
 
-    if data.startswith("stop_"):
-        tid = data.split("stop_")[1]
-        if tid in running_processes and running_processes[tid]["process"].poll() is None:
-            try:
-                os.killpg(os.getpgid(running_processes[tid]["process"].pid), signal.SIGTERM)
-            except:
-                pass
-            running_processes[tid]["process"].wait()
-            await query.edit_message_text(f"🛑 Stopped `{tid}`", parse_mode="Markdown")
-        else:
-            await query.message.reply_text("⚠️ Already stopped.")
-        return
+    btns = []
+    if running:
+        btns.append([InlineKeyboardButton("🛑 Stop", callback_data=f"stop_{target_id}")])
+        btns.append([InlineKeyboardButton("🔗 URL", callback_data=f"url_{target_id}")])
+    else:
+        btns.append([InlineKeyboardButton("🚀 Run", callback_data=f"rerun_{target_id}")])
 
-    if data.startswith("rerun_"):
-        context.user_data["fallback_id"] = data.split("rerun_")[1]
-        await query.delete_message()
-        return await execute_logic(update, context)
+    btns.append([InlineKeyboardButton("📜 Logs", callback_data=f"log_{target_id}")])
+    btns.append([InlineKeyboardButton("🗑️ Delete", callback_data=f"del_{target_id}")])
 
-    if data.startswith("url_"):
-        tid = data.split("url_")[1]
-        await query.message.reply_text(f"🔗 `{BASE_URL}/status?script={tid}`", parse_mode="Markdown")
-        return
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode="Markdown")
 
-    if data.startswith("log_"):
-        tid = data.split("log_")[1]
-        path = os.path.join(UPLOAD_DIR, f"{tid.replace('|','_')}.log")
-        if os.path.exists(path):
-            await context.bot.send
+@callback_prefix("stop")
+async def _cb_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, tid):
+    query = update.callback_query
+    if is_running(tid):
+        await _stop_process(_procs[tid])
+        await query.edit_message_text(f"🛑 Stopped `{tid}`", parse_mode="Markdown")
+    else:
+        await query.message.reply_text("⚠️ Already stopped.")
+
+@callback_prefix("rerun")
+async def _cb_rerun(update: Update, context: ContextTypes.DEFAULT_TYPE, tid):
+    context.user_data["fallback_id"] = tid
+    await update.callback_query.delete_message()
+    return await execute_logic(update, context)
+
+@callback_prefix("url")
+async def _cb_url(update: Update, context: ContextTypes.DEFAULT_TYPE, tid):
+    await update.callback_query.message.reply_text(f"🔗 `{BASE_URL}/status?script={tid}`", parse_mode="Markdown")
+
+@callback_prefix("log")
+async def _cb_log(update: Update, context: ContextTypes.DEFAULT_TYPE, tid):
+    path = get_launch_paths(tid)["log"]
+    if os.path.exists(path):
+        await context.bot.send